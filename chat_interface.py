@@ -18,6 +18,7 @@ class ImprovedChatInterface:
         self.openai_api_key = os.getenv('OPENAI_API_KEY')
         self.qdrant_url = os.getenv('QDRANT_URL', 'localhost')
         self.qdrant_port = int(os.getenv('QDRANT_PORT', '6333'))
+        self.qdrant_grpc_port = int(os.getenv('QDRANT_GRPC_PORT', str(self.qdrant_port + 1)))
         
         if not self.database_url or not self.openai_api_key:
             raise ValueError("DATABASE_URL and OPENAI_API_KEY must be set in .env file")
@@ -32,7 +33,8 @@ class ImprovedChatInterface:
         self.vector_store = VectorStore(
             self.openai_api_key,
             self.qdrant_url,
-            self.qdrant_port
+            self.qdrant_port,
+            qdrant_grpc_port=self.qdrant_grpc_port
         )
         self.query_processor = QueryProcessor(self.openai_api_key, self.database_url)
 
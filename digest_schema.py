@@ -53,6 +53,7 @@ def main():
         openai_api_key = os.getenv('OPENAI_API_KEY')
         qdrant_url = os.getenv('QDRANT_URL', 'localhost')
         qdrant_port = int(os.getenv('QDRANT_PORT', '6333'))
+        qdrant_grpc_port = int(os.getenv('QDRANT_GRPC_PORT', str(qdrant_port + 1)))
         
         if not database_url or not openai_api_key:
             raise ValueError("DATABASE_URL and OPENAI_API_KEY must be set in .env file")
@@ -79,7 +80,8 @@ def main():
         vector_store = VectorStore(
             openai_api_key,
             qdrant_url,
-            qdrant_port
+            qdrant_port,
+            qdrant_grpc_port=qdrant_grpc_port
         )
         
         vector_store.store_schema_embeddings(enriched_schema)
@@ -1,49 +1,79 @@
 from openai import OpenAI
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Optional, Tuple
 import logging
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sqlalchemy import create_engine, text
 import pandas as pd
 import re
 
+PG_KEYWORDS = frozenset({
+    'all', 'analyse', 'analyze', 'and', 'any', 'array', 'as', 'asc', 
+    'asymmetric', 'authorization', 'binary', 'both', 'case', 'cast', 
+    'check', 'collate', 'column', 'constraint', 'create', 'cross', 
+    'current_date', 'current_role', 'current_time', 'current_timestamp', 
+    'current_user', 'default', 'deferrable', 'desc', 'distinct', 'do', 
+    'else', 'end', 'except', 'false', 'for', 'foreign', 'freeze', 'from', 
+    'full', 'grant', 'group', 'having', 'ilike', 'in', 'initially', 'inner', 
+    'intersect', 'into', 'is', 'isnull', 'join', 'leading', 'left', 'like', 
+    'limit', 'localtime', 'localtimestamp', 'natural', 'not', 'notnull', 
+    'null', 'offset', 'on', 'only', 'or', 'order', 'outer', 'overlaps', 
+    'placing', 'primary', 'references', 'right', 'select', 'session_user', 
+    'similar', 'some', 'symmetric', 'table', 'then', 'to', 'trailing', 
+    'true', 'union', 'unique', 'user', 'using', 'verbose', 'when', 'where'
+})
+
+SQL_GUIDELINES = """4. For PostgreSQL, use NOW() - INTERVAL '1 month' for date arithmetic.
+5. Do not include trailing commas in column lists.
+6. Use table aliases for better readability (e.g., emp for employee).
+7. Ensure proper SQL syntax, especially in SELECT clause.
+8. Use LEFT JOINs when joining optional tables to preserve main records."""
+
 class QueryProcessor:
 
+    TABLE_PATTERN = re.compile(r'\b(FROM|JOIN|UPDATE|INTO|TABLE)\s+([a-zA-Z_][a-zA-Z0-9_]*)\b', re.IGNORECASE)
+    TRAILING_COMMA_PATTERNS = [
+        re.compile(r',(\s*FROM\b)', re.IGNORECASE),
+        re.compile(r',(\s*WHERE\b)', re.IGNORECASE),
+        re.compile(r',(\s*GROUP\s+BY\b)', re.IGNORECASE),
+        re.compile(r',(\s*ORDER\s+BY\b)', re.IGNORECASE)
+    ]
+
     def __init__(self, openai_api_key: str, database_url: str):
 
         self.client = OpenAI(api_key=openai_api_key)
         self.database_url = database_url
-        self.engine = create_engine(database_url)
+        self.engine = create_engine(
+            database_url,
+            pool_size=10,
+            max_overflow=5,
+            pool_recycle=1800,
+            pool_pre_ping=True
+        )
         
         self.logger = logging.getLogger("QueryProcessor")
         self.logger.setLevel(logging.INFO)
         
         self.MAX_TOKENS = 4000
         self.TOKENS_PER_TABLE = 800
+        self.RESULT_CHUNK_SIZE = 10000
+        self.MAX_CHUNK_WORKERS = 4
+        self.CONFIDENCE_THRESHOLD = 0.9
+        
+        self.SCHEMA_CONTEXT_CACHE_SIZE = 256
+        self._schema_context_cache: Dict[Tuple[str, ...], str] = {}
+        self._schema_context_lock = threading.Lock()
 
     def _needs_quoting(self, identifier: str) -> bool:
 
-        pg_keywords = {
-            'all', 'analyse', 'analyze', 'and', 'any', 'array', 'as', 'asc', 
-            'asymmetric', 'authorization', 'binary', 'both', 'case', 'cast', 
-            'check', 'collate', 'column', 'constraint', 'create', 'cross', 
-            'current_date', 'current_role', 'current_time', 'current_timestamp', 
-            'current_user', 'default', 'deferrable', 'desc', 'distinct', 'do', 
-            'else', 'end', 'except', 'false', 'for', 'foreign', 'freeze', 'from', 
-            'full', 'grant', 'group', 'having', 'ilike', 'in', 'initially', 'inner', 
-            'intersect', 'into', 'is', 'isnull', 'join', 'leading', 'left', 'like', 
-            'limit', 'localtime', 'localtimestamp', 'natural', 'not', 'notnull', 
-            'null', 'offset', 'on', 'only', 'or', 'order', 'outer', 'overlaps', 
-            'placing', 'primary', 'references', 'right', 'select', 'session_user', 
-            'similar', 'some', 'symmetric', 'table', 'then', 'to', 'trailing', 
-            'true', 'union', 'unique', 'user', 'using', 'verbose', 'when', 'where'
-        }
-        
-        return (
-            identifier.upper() == identifier or
-            identifier.lower() != identifier or
-            ' ' in identifier or
-            any(c in identifier for c in '.-') or
-            identifier.lower() in pg_keywords
-        )
+        lowered = identifier.lower()
+        if lowered != identifier or identifier.upper() == identifier:
+            return True
+        for c in identifier:
+            if c in ' .-':
+                return True
+        return lowered in PG_KEYWORDS
 
     def _quote_identifier(self, identifier: str) -> str:
 
@@ -55,8 +85,6 @@ class QueryProcessor:
 
         table_case_map = {name.lower(): name for name in table_names}
         
-        table_pattern = r'\b(FROM|JOIN|UPDATE|INTO|TABLE)\s+([a-zA-Z_][a-zA-Z0-9_]*)\b'
-        
         def replace_table_name(match):
             keyword = match.group(1)
             table_name = match.group(2)
@@ -64,7 +92,7 @@ class QueryProcessor:
             quoted_name = self._quote_identifier(original_case)
             return f"{keyword} {quoted_name}"
         
-        processed_query = re.sub(table_pattern, replace_table_name, sql_query, flags=re.IGNORECASE)
+        processed_query = self.TABLE_PATTERN.sub(replace_table_name, sql_query)
         return processed_query
 
     def validate_tables(self, relevant_tables: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -85,8 +113,9 @@ Note: Preserve the exact case of table names."""},
         ]
         
         response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=messages
+            model="gpt-4o-mini",
+            messages=messages,
+            max_tokens=256
         )
         
         validated_tables = response.choices[0].message.content.strip().split(',')
@@ -96,30 +125,57 @@ Note: Preserve the exact case of table names."""},
             if table['table_name'] in validated_tables
         ]
 
-    def process_schema_chunk(self, tables: List[Dict[str, Any]], query: str) -> str:
+    def _build_schema_context(self, tables: List[Dict[str, Any]]) -> str:
 
-        schema_context = ""
-        table_names = []
+        tables_key = tuple(table['table_name'] for table in tables)
+        with self._schema_context_lock:
+            cached_context = self._schema_context_cache.get(tables_key)
+        if cached_context is not None:
+            return cached_context
+        
+        schema_context = self._render_schema_context(tables)
+        with self._schema_context_lock:
+            if len(self._schema_context_cache) >= self.SCHEMA_CONTEXT_CACHE_SIZE:
+                del self._schema_context_cache[next(iter(self._schema_context_cache))]
+            self._schema_context_cache[tables_key] = schema_context
+        return schema_context
+
+    def _render_schema_context(self, tables: List[Dict[str, Any]]) -> str:
+
+        parts = []
         for table in tables:
             table_name = self._quote_identifier(table['table_name'])
-            table_names.append(table['table_name'])
-            schema_context += f"\nTable: {table_name}\n"
-            schema_context += f"Description: {table['description']}\n"
-            schema_context += "Columns:\n"
+            parts.append(f"\nTable: {table_name}\nDescription: {table['description']}\nColumns:\n")
             for col_name, col_info in table['schema']['columns'].items():
                 attrs = []
                 if not col_info['nullable']:
                     attrs.append("NOT NULL")
                 if col_info.get('primary_key'):
                     attrs.append("PRIMARY KEY")
-                schema_context += f"- {col_name} ({col_info['type']}) {' '.join(attrs)}\n"
+                parts.append(f"- {col_name} ({col_info['type']}) {' '.join(attrs)}\n")
             
             if table['schema']['foreign_keys']:
-                schema_context += "\nForeign Keys:\n"
+                parts.append("\nForeign Keys:\n")
                 for fk in table['schema']['foreign_keys']:
                     referred_table = self._quote_identifier(fk['referred_table'])
-                    schema_context += f"- {', '.join(fk['constrained_columns'])} -> "
-                    schema_context += f"{referred_table}({', '.join(fk['referred_columns'])})\n"
+                    parts.append(f"- {', '.join(fk['constrained_columns'])} -> "
+                                 f"{referred_table}({', '.join(fk['referred_columns'])})\n")
+        
+        return ''.join(parts)
+
+    def _clean_sql_query(self, sql_query: str, table_names: List[str]) -> str:
+
+        sql_query = sql_query.replace('```sql', '').replace('```', '').strip()
+        
+        for pattern in self.TRAILING_COMMA_PATTERNS:
+            sql_query = pattern.sub(r'\1', sql_query)
+        
+        return self._process_sql_query(sql_query, table_names)
+
+    def process_schema_chunk(self, tables: List[Dict[str, Any]], query: str) -> str:
+
+        schema_context = self._build_schema_context(tables)
+        table_names = [table['table_name'] for table in tables]
         
         messages = [
             {"role": "system", "content": f"""You are a SQL expert. Using the following schema, generate a SQL query for the user's request.
@@ -131,11 +187,7 @@ Important notes:
 1. Some table names are case-sensitive. Use the exact table names as shown above.
 2. Generate ONLY the SQL query without any markdown formatting or explanation.
 3. Do not include ```sql or ``` markers.
-4. For PostgreSQL, use NOW() - INTERVAL '1 month' for date arithmetic.
-5. Do not include trailing commas in column lists.
-6. Use table aliases for better readability (e.g., emp for employee).
-7. Ensure proper SQL syntax, especially in SELECT clause.
-8. Use LEFT JOINs when joining optional tables to preserve main records."""},
+{SQL_GUIDELINES}"""},
             {"role": "user", "content": query}
         ]
         
@@ -144,41 +196,103 @@ Important notes:
             messages=messages
         )
         
-        sql_query = response.choices[0].message.content.strip()
+        return self._clean_sql_query(response.choices[0].message.content.strip(), table_names)
 
-        sql_query = sql_query.replace('```sql', '').replace('```', '').strip()
+    def generate_sql_single_pass(self, tables: List[Dict[str, Any]], query: str) -> Optional[str]:
+
+        schema_context = self._build_schema_context(tables)
+        table_names = [table['table_name'] for table in tables]
         
-        sql_query = re.sub(r',(\s*FROM)', r'\1', sql_query)
-        sql_query = re.sub(r',(\s*WHERE)', r'\1', sql_query)
-        sql_query = re.sub(r',(\s*GROUP\s+BY)', r'\1', sql_query)
-        sql_query = re.sub(r',(\s*ORDER\s+BY)', r'\1', sql_query)
+        messages = [
+            {"role": "system", "content": f"""You are a SQL expert. The following tables were retrieved as candidates for the user's request.
+Some of them may be irrelevant. Pick only the tables that are truly needed and generate a SQL query for the request.
+The query should be efficient and use proper joins when necessary.
+
+{schema_context}
+
+Respond with a JSON object with exactly these keys:
+- "used_tables": list of the table names used by the query, with their exact case
+- "sql": the SQL query as a plain string, without markdown formatting
+- "confidence": your confidence (0.0 to 1.0) that the query answers the request
+
+Important notes:
+1. Some table names are case-sensitive. Use the exact table names as shown above.
+2. Do not reference tables that are not listed above.
+3. Do not include ```sql or ``` markers in the query.
+{SQL_GUIDELINES}"""},
+            {"role": "user", "content": query}
+        ]
         
-        return self._process_sql_query(sql_query, table_names)
+        response = self.client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
+        
+        content = response.choices[0].message.content
+        if not content:
+            self.logger.warning("Single-pass SQL generation returned no content")
+            return None
+        
+        try:
+            result = json.loads(content)
+        except json.JSONDecodeError:
+            self.logger.warning("Single-pass SQL generation returned invalid JSON")
+            return None
+        
+        sql_query = result.get('sql') if isinstance(result, dict) else None
+        if not isinstance(sql_query, str) or not sql_query.strip():
+            return None
+        
+        self.logger.info(f"Single-pass SQL generation used tables {result.get('used_tables')} "
+                         f"with confidence {result.get('confidence')}")
+        return self._clean_sql_query(sql_query.strip(), table_names)
 
     def generate_sql(self, query: str, relevant_tables: List[Dict[str, Any]]) -> str:
 
-        validated_tables = self.validate_tables(relevant_tables)
-        
         tables_per_chunk = max(1, self.MAX_TOKENS // self.TOKENS_PER_TABLE)
         
+        if len(relevant_tables) <= tables_per_chunk:
+            sql_query = self.generate_sql_single_pass(relevant_tables, query)
+            if sql_query:
+                return sql_query
+        
+        validated_tables = self.validate_tables(relevant_tables)
+        
         if len(validated_tables) <= tables_per_chunk:
             return self.process_schema_chunk(validated_tables, query)
         
+        chunks = [
+            validated_tables[i:i + tables_per_chunk]
+            for i in range(0, len(validated_tables), tables_per_chunk)
+        ]
+        
         best_query = None
         highest_confidence = 0
         
-        for i in range(0, len(validated_tables), tables_per_chunk):
-            chunk = validated_tables[i:i + tables_per_chunk]
-            proposed_query = self.process_schema_chunk(chunk, query)
-            
-            confidence = self.evaluate_query_confidence(proposed_query, query, chunk)
-            
-            if confidence > highest_confidence:
-                best_query = proposed_query
-                highest_confidence = confidence
+        executor = ThreadPoolExecutor(max_workers=min(self.MAX_CHUNK_WORKERS, len(chunks)))
+        try:
+            futures = [executor.submit(self._generate_scored_query, chunk, query) for chunk in chunks]
+            for future in as_completed(futures):
+                proposed_query, confidence = future.result()
+                
+                if confidence > highest_confidence:
+                    best_query = proposed_query
+                    highest_confidence = confidence
+                
+                if confidence >= self.CONFIDENCE_THRESHOLD:
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
         
         return best_query
 
+    def _generate_scored_query(self, chunk: List[Dict[str, Any]], query: str) -> Tuple[str, float]:
+
+        proposed_query = self.process_schema_chunk(chunk, query)
+        confidence = self.evaluate_query_confidence(proposed_query, query, chunk)
+        return proposed_query, confidence
+
     def evaluate_query_confidence(self, sql_query: str, original_query: str, 
                                 tables: List[Dict[str, Any]]) -> float:
 
@@ -203,8 +317,10 @@ Return only the numeric score."""},
         ]
         
         response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=messages
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0,
+            max_tokens=64
         )
         
         try:
@@ -212,13 +328,29 @@ Return only the numeric score."""},
         except ValueError:
             return 0.0
 
-    def execute_query(self, sql_query: str) -> Tuple[pd.DataFrame, str]:
+    def _read_query(self, sql_query: str, dtype_backend: Optional[str] = None) -> pd.DataFrame:
+
+        read_options = {'dtype_backend': dtype_backend} if dtype_backend else {}
+        with self.engine.connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            chunks = list(pd.read_sql_query(
+                text(sql_query),
+                connection,
+                chunksize=self.RESULT_CHUNK_SIZE,
+                **read_options
+            ))
+        return pd.concat(chunks, ignore_index=True, copy=False)
+
+    def execute_query(self, sql_query: str, arrow: bool = True) -> Tuple[pd.DataFrame, str]:
 
         try:
-            with self.engine.connect() as connection:
-                result = connection.execute(text(sql_query))
-                df = pd.DataFrame(result.fetchall(), columns=result.keys())
-                return df, sql_query
+            if not arrow:
+                return self._read_query(sql_query), sql_query
+            try:
+                return self._read_query(sql_query, dtype_backend='pyarrow'), sql_query
+            except (ImportError, TypeError, ValueError) as e:
+                self.logger.warning(f"Falling back to default dtypes: {str(e)}")
+                return self._read_query(sql_query), sql_query
         except Exception as e:
             self.logger.error(f"Error executing query: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
\ No newline at end of file
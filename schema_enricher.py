@@ -1,11 +1,20 @@
 from sqlalchemy import create_engine, inspect
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
 import json
 import os
-from typing import Dict, List, Any, Set
+from typing import Dict, List, Any, Optional, Set
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import fnmatch
+import hashlib
+import re
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class SchemaEnricher:
 
@@ -16,13 +25,26 @@ class SchemaEnricher:
         self.client = OpenAI(api_key=openai_api_key)
         self.cache_dir = cache_dir
         self.enriched_schema_file = os.path.join(cache_dir, "enriched_schema.json")
+        self.descriptions_dir = os.path.join(cache_dir, "table_descriptions")
         
         self.logger = logging.getLogger("SchemaEnricher")
         self.logger.setLevel(logging.INFO)
         
+        self.MAX_WORKERS = 16
+        self.MAX_RETRIES = 5
+        self.BATCH_THRESHOLD = 20
+        self.BATCH_POLL_INTERVAL = 30
+        self.BATCH_TIMEOUT = 2 * 60 * 60
+        
         os.makedirs(cache_dir, exist_ok=True)
+        os.makedirs(self.descriptions_dir, exist_ok=True)
         
         self.ignored_tables = self._load_ignored_tables()
+        self._ignored_patterns = sorted(self.ignored_tables)
+        self._ignore_re = re.compile('|'.join(
+            f'(?P<p{i}>{fnmatch.translate(pattern.lower())})'
+            for i, pattern in enumerate(self._ignored_patterns)
+        )) if self._ignored_patterns else None
 
     def _load_ignored_tables(self) -> Set[str]:
 
@@ -37,10 +59,13 @@ class SchemaEnricher:
 
     def _should_process_table(self, table_name: str) -> bool:
 
-        for pattern in self.ignored_tables:
-            if fnmatch.fnmatch(table_name.lower(), pattern.lower()):
-                self.logger.info(f"Skipping table {table_name} (matched pattern {pattern})")
-                return False
+        if self._ignore_re is None:
+            return True
+        match = self._ignore_re.match(table_name.lower())
+        if match:
+            pattern = self._ignored_patterns[int(match.lastgroup[1:])]
+            self.logger.info(f"Skipping table {table_name} (matched pattern {pattern})")
+            return False
         return True
 
     def extract_schema(self) -> Dict[str, Any]:
@@ -48,15 +73,24 @@ class SchemaEnricher:
         inspector = inspect(self.engine)
         schema_info = {}
         
-        for table_name in inspector.get_table_names():
-
-            if not self._should_process_table(table_name):
-                continue
-                
-            columns = inspector.get_columns(table_name)
-            foreign_keys = inspector.get_foreign_keys(table_name)
-            primary_key = inspector.get_pk_constraint(table_name)
-            indexes = inspector.get_indexes(table_name)
+        table_names = [
+            table_name for table_name in inspector.get_table_names()
+            if self._should_process_table(table_name)
+        ]
+        if not table_names:
+            return schema_info
+        
+        all_columns = inspector.get_multi_columns(filter_names=table_names)
+        all_foreign_keys = inspector.get_multi_foreign_keys(filter_names=table_names)
+        all_primary_keys = inspector.get_multi_pk_constraint(filter_names=table_names)
+        all_indexes = inspector.get_multi_indexes(filter_names=table_names)
+        
+        for table_name in table_names:
+            key = (None, table_name)
+            columns = all_columns.get(key, [])
+            foreign_keys = all_foreign_keys.get(key, [])
+            primary_key = all_primary_keys.get(key)
+            indexes = all_indexes.get(key, [])
             
             schema_info[table_name] = {
                 'columns': {
@@ -68,18 +102,38 @@ class SchemaEnricher:
                     } for col in columns
                 },
                 'foreign_keys': foreign_keys,
-                'primary_key': primary_key.get('constrained_columns', []),
+                'primary_key': primary_key.get('constrained_columns', []) if primary_key else [],
                 'indexes': indexes
             }
         
         return schema_info
 
-    def enrich_table_schema(self, table_name: str, schema_info: Dict) -> str:
+    def _schema_fingerprint(self, table_name: str, table_info: Dict) -> str:
 
-        table_info = schema_info[table_name]
-        
-        context = f"Table: {table_name}\n"
-        context += "Columns:\n"
+        serialized = json.dumps([table_name, table_info], sort_keys=True, default=str)
+        return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+    def _description_cache_file(self, table_name: str, table_info: Dict) -> str:
+
+        fingerprint = self._schema_fingerprint(table_name, table_info)
+        return os.path.join(self.descriptions_dir, f"{fingerprint}.txt")
+
+    def _load_cached_description(self, table_name: str, table_info: Dict) -> Optional[str]:
+
+        cached_file = self._description_cache_file(table_name, table_info)
+        if os.path.exists(cached_file):
+            with open(cached_file, 'r', encoding='utf-8') as f:
+                return f.read()
+        return None
+
+    def _save_cached_description(self, table_name: str, table_info: Dict, description: str):
+
+        with open(self._description_cache_file(table_name, table_info), 'w', encoding='utf-8') as f:
+            f.write(description)
+
+    def _build_enrichment_messages(self, table_name: str, table_info: Dict) -> List[Dict[str, str]]:
+
+        parts = [f"Table: {table_name}\nColumns:\n"]
         for col_name, col_info in table_info['columns'].items():
             attrs = []
             if not col_info['nullable']:
@@ -88,14 +142,16 @@ class SchemaEnricher:
                 attrs.append("PRIMARY KEY")
             if col_info['default'] != "None":
                 attrs.append(f"DEFAULT {col_info['default']}")
-            context += f"- {col_name} ({col_info['type']}) {' '.join(attrs)}\n"
+            parts.append(f"- {col_name} ({col_info['type']}) {' '.join(attrs)}\n")
         
         if table_info['foreign_keys']:
-            context += "\nRelationships:\n"
+            parts.append("\nRelationships:\n")
             for fk in table_info['foreign_keys']:
-                context += f"- References {fk['referred_table']} ({', '.join(fk['referred_columns'])})\n"
+                parts.append(f"- References {fk['referred_table']} ({', '.join(fk['referred_columns'])})\n")
         
-        messages = [
+        context = ''.join(parts)
+        
+        return [
             {"role": "system", "content": """You are a database expert. Analyze the provided table schema and generate a detailed description including:
 1. The purpose of the table
 2. Explanation of key columns
@@ -104,13 +160,129 @@ class SchemaEnricher:
 Be concise but comprehensive."""},
             {"role": "user", "content": context}
         ]
+
+    def enrich_table_schema(self, table_name: str, schema_info: Dict) -> str:
+
+        table_info = schema_info[table_name]
         
-        response = self.client.chat.completions.create(
+        cached_description = self._load_cached_description(table_name, table_info)
+        if cached_description is not None:
+            return cached_description
+        
+        response = self._create_chat_completion(
             model="gpt-3.5-turbo",
-            messages=messages
+            messages=self._build_enrichment_messages(table_name, table_info)
         )
         
-        return response.choices[0].message.content.strip()
+        description = response.choices[0].message.content.strip()
+        self._save_cached_description(table_name, table_info, description)
+        return description
+
+    def enrich_tables_with_batch(self, table_names: List[str], schema_info: Dict) -> Dict[str, str]:
+
+        batch_requests = [
+            json.dumps({
+                "custom_id": table_name,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-3.5-turbo",
+                    "messages": self._build_enrichment_messages(table_name, schema_info[table_name])
+                }
+            })
+            for table_name in table_names
+        ]
+        
+        try:
+            batch_file = self.client.files.create(
+                file=("schema_enrichment.jsonl", "\n".join(batch_requests).encode()),
+                purpose="batch"
+            )
+            batch = self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+        except Exception as e:
+            self.logger.warning(f"Could not submit enrichment batch: {str(e)}")
+            return {}
+        self.logger.info(f"Submitted batch {batch.id} for {len(table_names)} tables")
+        
+        deadline = time.time() + self.BATCH_TIMEOUT
+        poll_failures = 0
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if time.time() >= deadline:
+                self.logger.warning(f"Batch {batch.id} did not finish within {self.BATCH_TIMEOUT}s")
+                self._cancel_batch(batch.id)
+                return {}
+            
+            time.sleep(self.BATCH_POLL_INTERVAL)
+            try:
+                batch = self.client.batches.retrieve(batch.id)
+                poll_failures = 0
+            except Exception as e:
+                poll_failures += 1
+                self.logger.warning(f"Error polling batch {batch.id}: {str(e)}")
+                if poll_failures >= self.MAX_RETRIES:
+                    self._cancel_batch(batch.id)
+                    return {}
+                continue
+            
+            if batch.request_counts:
+                self.logger.info(f"Batch {batch.id} {batch.status}: "
+                                 f"{batch.request_counts.completed}/{batch.request_counts.total} completed, "
+                                 f"{batch.request_counts.failed} failed")
+        
+        descriptions = {}
+        if batch.status != "completed" or not batch.output_file_id:
+            self.logger.warning(f"Batch {batch.id} finished with status {batch.status}")
+            return descriptions
+        
+        try:
+            output = self.client.files.content(batch.output_file_id).text
+        except Exception as e:
+            self.logger.warning(f"Could not download results of batch {batch.id}: {str(e)}")
+            return descriptions
+        
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if response.get('status_code') != 200:
+                    continue
+                table_name = result['custom_id']
+                description = response['body']['choices'][0]['message']['content'].strip()
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                self.logger.warning(f"Skipping malformed batch result: {str(e)}")
+                continue
+            if table_name not in schema_info:
+                continue
+            self._save_cached_description(table_name, schema_info[table_name], description)
+            descriptions[table_name] = description
+        
+        return descriptions
+
+    def _cancel_batch(self, batch_id: str):
+
+        try:
+            self.client.batches.cancel(batch_id)
+            self.logger.info(f"Cancelled batch {batch_id}, falling back to direct requests")
+        except Exception as e:
+            self.logger.warning(f"Could not cancel batch {batch_id}: {str(e)}")
+
+    def _create_chat_completion(self, **kwargs):
+
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                return self.client.chat.completions.create(**kwargs)
+            except RateLimitError:
+                if attempt == self.MAX_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt
+                self.logger.warning(f"Rate limited by OpenAI, retrying in {delay}s")
+                time.sleep(delay)
 
     def process_schema(self) -> Dict[str, Any]:
         
@@ -125,16 +297,43 @@ Be concise but comprehensive."""},
             'tables': {}
         }
         
+        descriptions = {}
+        pending_tables = []
+        for table_name, table_info in schema_info.items():
+            cached_description = self._load_cached_description(table_name, table_info)
+            if cached_description is not None:
+                descriptions[table_name] = cached_description
+            else:
+                pending_tables.append(table_name)
+        
+        if len(pending_tables) >= self.BATCH_THRESHOLD:
+            descriptions.update(self.enrich_tables_with_batch(pending_tables, schema_info))
+            pending_tables = [table_name for table_name in pending_tables if table_name not in descriptions]
+        
+        if pending_tables:
+            max_workers = min(self.MAX_WORKERS, len(pending_tables))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(self.enrich_table_schema, table_name, schema_info): table_name
+                    for table_name in pending_tables
+                }
+                for future in as_completed(futures):
+                    table_name = futures[future]
+                    descriptions[table_name] = future.result()
+                    self.logger.info(f"Enriched schema for table: {table_name}")
+        
         for table_name in schema_info.keys():
-            self.logger.info(f"Enriching schema for table: {table_name}")
-            description = self.enrich_table_schema(table_name, schema_info)
             enriched_schema['tables'][table_name] = {
                 'schema': schema_info[table_name],
-                'description': description
+                'description': descriptions[table_name]
             }
         
-        with open(self.enriched_schema_file, 'w') as f:
-            json.dump(enriched_schema, f, indent=2)
+        if orjson is not None:
+            with open(self.enriched_schema_file, 'wb') as f:
+                f.write(orjson.dumps(enriched_schema, option=orjson.OPT_INDENT_2))
+        else:
+            with open(self.enriched_schema_file, 'w') as f:
+                json.dump(enriched_schema, f, indent=2)
         
         self.logger.info("Schema enrichment completed successfully")
         return enriched_schema
@@ -142,6 +341,9 @@ Be concise but comprehensive."""},
     def load_enriched_schema(self) -> Dict[str, Any]:
         
         if os.path.exists(self.enriched_schema_file):
+            if orjson is not None:
+                with open(self.enriched_schema_file, 'rb') as f:
+                    return orjson.loads(f.read())
             with open(self.enriched_schema_file, 'r') as f:
                 return json.load(f)
         return None 
\ No newline at end of file
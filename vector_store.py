@@ -2,89 +2,223 @@ from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from openai import OpenAI
 import numpy as np
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+from collections import OrderedDict
 import logging
+import hashlib
 import json
 import os
 
 class VectorStore:
 
     def __init__(self, openai_api_key: str, qdrant_url: str = "localhost", 
-                 qdrant_port: int = 6333, collection_name: str = "schema_embeddings_new"):
+                 qdrant_port: int = 6333, collection_name: str = "schema_embeddings_new",
+                 qdrant_grpc_port: Optional[int] = None, cache_dir: str = ".cache"):
         
         self.client = OpenAI(api_key=openai_api_key)
-        self.qdrant = QdrantClient(host=qdrant_url, port=qdrant_port)
+        self.qdrant = QdrantClient(
+            host=qdrant_url,
+            port=qdrant_port,
+            grpc_port=qdrant_grpc_port or qdrant_port + 1,
+            prefer_grpc=True
+        )
         self.collection_name = collection_name
         
         self.logger = logging.getLogger("VectorStore")
         self.logger.setLevel(logging.INFO)
         
+        self.EMBEDDING_BATCH_SIZE = 100
+        self.PARALLEL_UPLOAD_THRESHOLD = 256
+        self.EMBEDDING_CACHE_SIZE = 1024
+        
+        self.query_embeddings_dir = os.path.join(cache_dir, "query_embeddings")
+        os.makedirs(self.query_embeddings_dir, exist_ok=True)
+        self._embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        
+        self.RELEVANT_CACHE_SIZE = 256
+        self.NEAR_DUPLICATE_THRESHOLD = 0.98
+        self._relevant_cache: Dict[Tuple[str, int], Tuple[np.ndarray, List[Dict[str, Any]]]] = {}
+        
         self._init_collection()
 
     def _init_collection(self):
 
+        quantization_config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
+        
         try:
-            self.qdrant.get_collection(self.collection_name)
+            collection = self.qdrant.get_collection(self.collection_name)
         except Exception:
             self.qdrant.create_collection(
                 collection_name=self.collection_name,
                 vectors_config=models.VectorParams(
                     size=1536,
                     distance=models.Distance.COSINE
-                )
+                ),
+                quantization_config=quantization_config
+            )
+            return
+        
+        if collection.config.quantization_config is None:
+            self.logger.info(f"Enabling scalar quantization on {self.collection_name}")
+            self.qdrant.update_collection(
+                collection_name=self.collection_name,
+                quantization_config=quantization_config
             )
 
     def generate_embedding(self, text: str) -> np.ndarray:
 
-        response = self.client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return np.array(response.data[0].embedding)
+        if text in self._embedding_cache:
+            self._embedding_cache.move_to_end(text)
+            return self._embedding_cache[text].copy()
+        
+        key = hashlib.sha1(text.encode()).hexdigest()
+        cached_file = os.path.join(self.query_embeddings_dir, f"{key}.npy")
+        if os.path.exists(cached_file):
+            embedding = np.load(cached_file)
+        else:
+            embedding = self.generate_embeddings([text])[0]
+            np.save(cached_file, embedding)
+        
+        self._embedding_cache[text] = embedding
+        if len(self._embedding_cache) > self.EMBEDDING_CACHE_SIZE:
+            self._embedding_cache.popitem(last=False)
+        return embedding.copy()
+
+    def generate_embeddings(self, texts: List[str]) -> np.ndarray:
+
+        embeddings = []
+        for i in range(0, len(texts), self.EMBEDDING_BATCH_SIZE):
+            response = self.client.embeddings.create(
+                model="text-embedding-3-small",
+                input=texts[i:i + self.EMBEDDING_BATCH_SIZE]
+            )
+            embeddings.extend(item.embedding for item in response.data)
+        return np.array(embeddings)
+
+    def _point_id(self, table_name: str) -> int:
+
+        return int(hashlib.blake2b(table_name.encode(), digest_size=8).hexdigest(), 16)
+
+    def _point_fingerprint(self, text: str, schema: Dict[str, Any]) -> str:
+
+        serialized = json.dumps([text, schema], sort_keys=True, default=str)
+        return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+    def _get_stored_fingerprints(self) -> Dict[int, Optional[str]]:
+
+        fingerprints = {}
+        offset = None
+        while True:
+            records, offset = self.qdrant.scroll(
+                collection_name=self.collection_name,
+                limit=256,
+                offset=offset,
+                with_payload=['fingerprint'],
+                with_vectors=False
+            )
+            for record in records:
+                fingerprints[record.id] = (record.payload or {}).get('fingerprint')
+            if offset is None:
+                return fingerprints
 
     def store_schema_embeddings(self, enriched_schema: Dict[str, Any]):
 
         self.logger.info("Storing schema embeddings...")
         
-        self.qdrant.delete_collection(self.collection_name)
-        self._init_collection()
+        self._relevant_cache.clear()
         
-        points = []
+        stored_fingerprints = self._get_stored_fingerprints()
+        
+        current_ids = set()
+        changed_ids = []
+        texts_to_embed = []
+        payloads = []
         for table_name, table_info in enriched_schema['tables'].items():
-            text_to_embed = f"Table: {table_name}\n{table_info['description']}"
+            point_id = self._point_id(table_name)
+            current_ids.add(point_id)
             
-            embedding = self.generate_embedding(text_to_embed)
+            text_to_embed = f"Table: {table_name}\n{table_info['description']}"
+            fingerprint = self._point_fingerprint(text_to_embed, table_info['schema'])
+            if stored_fingerprints.get(point_id) == fingerprint:
+                continue
             
-            point = models.PointStruct(
-                id=len(points),
-                vector=embedding.tolist(),
-                payload={
-                    'table_name': table_name,
-                    'description': table_info['description'],
-                    'schema': table_info['schema']
-                }
+            changed_ids.append(point_id)
+            texts_to_embed.append(text_to_embed)
+            payloads.append({
+                'table_name': table_name,
+                'description': table_info['description'],
+                'schema': table_info['schema'],
+                'fingerprint': fingerprint
+            })
+        
+        stale_ids = [point_id for point_id in stored_fingerprints if point_id not in current_ids]
+        if stale_ids:
+            self.qdrant.delete(
+                collection_name=self.collection_name,
+                points_selector=models.PointIdsList(points=stale_ids)
             )
-            points.append(point)
         
-        self.qdrant.upsert(
-            collection_name=self.collection_name,
-            points=points
-        )
+        if changed_ids:
+            embeddings = self.generate_embeddings(texts_to_embed)
+            self.qdrant.upload_collection(
+                collection_name=self.collection_name,
+                vectors=embeddings,
+                payload=payloads,
+                ids=changed_ids,
+                batch_size=64,
+                parallel=4 if len(changed_ids) >= self.PARALLEL_UPLOAD_THRESHOLD else 1
+            )
+        
+        self.logger.info(f"Stored embeddings for {len(current_ids)} tables "
+                         f"({len(changed_ids)} updated, {len(stale_ids)} removed)")
+
+    def _find_cached_tables(self, query_embedding: np.ndarray, top_k: int) -> Optional[List[Dict[str, Any]]]:
+
+        candidates = [entry for key, entry in self._relevant_cache.items() if key[1] == top_k]
+        if not candidates:
+            return None
         
-        self.logger.info(f"Stored embeddings for {len(points)} tables")
+        cached_embeddings = np.array([embedding for embedding, _ in candidates])
+        similarities = cached_embeddings @ query_embedding / (
+            np.linalg.norm(cached_embeddings, axis=1) * np.linalg.norm(query_embedding)
+        )
+        best = int(np.argmax(similarities))
+        if similarities[best] > self.NEAR_DUPLICATE_THRESHOLD:
+            return candidates[best][1]
+        return None
 
     def find_relevant_tables(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
         
+        cache_key = (query, top_k)
+        if cache_key in self._relevant_cache:
+            return list(self._relevant_cache[cache_key][1])
+        
         query_embedding = self.generate_embedding(query)
         
-        search_result = self.qdrant.search(
+        cached_tables = self._find_cached_tables(query_embedding, top_k)
+        if cached_tables is not None:
+            return list(cached_tables)
+        
+        search_result = self.qdrant.query_points(
             collection_name=self.collection_name,
-            query_vector=query_embedding.tolist(),
-            limit=top_k
+            query=query_embedding.tolist(),
+            limit=top_k,
+            search_params=models.SearchParams(
+                quantization=models.QuantizationSearchParams(
+                    rescore=True,
+                    oversampling=2.0
+                )
+            )
         )
         
         relevant_tables = []
-        for scored_point in search_result:
+        for scored_point in search_result.points:
             relevant_tables.append({
                 'table_name': scored_point.payload['table_name'],
                 'description': scored_point.payload['description'],
@@ -92,4 +226,8 @@ class VectorStore:
                 'similarity_score': scored_point.score
             })
         
-        return relevant_tables 
\ No newline at end of file
+        if len(self._relevant_cache) >= self.RELEVANT_CACHE_SIZE:
+            del self._relevant_cache[next(iter(self._relevant_cache))]
+        self._relevant_cache[cache_key] = (query_embedding, relevant_tables)
+        
+        return list(relevant_tables) 
\ No newline at end of file